@@ -7,7 +7,9 @@ A solver for Dependency Quantified Boolean Formulas (DQBF).
 Uses the DQCIR parser to read formulas and provides a framework for solving.
 """
 
-from typing import Dict, List, Set, Tuple, Optional
+import sys
+from collections import defaultdict
+from typing import Callable, Dict, FrozenSet, List, Set, Tuple, Optional
 from pysat.solvers import Cadical195 as SAT
 from dqcir_parser import DQCIRParser
 from counter import Counter
@@ -69,18 +71,56 @@ class DQBFSolver:
       self.counter = counter
     
     # Derived data structures
-    self.existential_vars = set(dependencies.keys())
+    self.existential_vars = dependencies.keys()
     self.universal_var_ids = [name_to_id[v] for v in universal_vars]
-    self.existential_var_ids = [name_to_id[v] for v in self.existential_vars]
     
-    # Convert dependencies to ID-based mapping
-    self.dependencies_by_id: Dict[int, Set[int]] = {}
+    # Convert dependencies to ID-based mappings in a single pass
+    # _dependents_of maps each universal variable ID to the existential variable IDs depending on it
+    # _dep_index maps each existential variable ID to a dict from dependency ID to bit position,
+    # used to pack assignments into integer keys
+    self.existential_var_ids: List[int] = []
+    self.dependencies_by_id: Dict[int, FrozenSet[int]] = {}
     self.dependencies_by_id_list: Dict[int, List[int]] = {}
+    self._dependents_of: Dict[int, List[int]] = defaultdict(list)
+    self._dep_index: Dict[int, Dict[int, int]] = {}
     for exist_var, deps in dependencies.items():
       exist_id = name_to_id[exist_var]
       dep_ids = [name_to_id[dep] for dep in deps]
-      self.dependencies_by_id[exist_id] = set(dep_ids)
+      dep_set = frozenset(dep_ids)
+      self.existential_var_ids.append(exist_id)
+      self.dependencies_by_id[exist_id] = dep_set
       self.dependencies_by_id_list[exist_id] = dep_ids
+      self._dep_index[exist_id] = {dep_id: pos for pos, dep_id in enumerate(dep_ids)}
+      for dep_id in dep_set:
+        self._dependents_of[dep_id].append(exist_id)
+    
+    # Compact index (0..E-1) of each existential variable
+    # Key: existential variable ID, Value: position in existential_var_ids
+    self._exist_index: Dict[int, int] = {exist_id: i for i, exist_id in enumerate(self.existential_var_ids)}
+    
+    # Hashed view of the existential variable IDs for O(1) membership tests
+    self._exist_id_set: FrozenSet[int] = frozenset(self.existential_var_ids)
+    
+    # Sorted variable IDs used to read assignments directly out of SAT models
+    self._exist_ids_sorted: List[int] = sorted(self._exist_id_set)
+    self._univ_ids_sorted: List[int] = sorted(set(self.universal_var_ids))
+    
+    # Bit layout of universal assignments packed into an integer mask: universal_var_ids[i]
+    # is bit (n - 1 - i), so reading the mask as a binary number gives the values in variable order
+    # Key: universal variable ID (in universal_var_ids order), Value: bit position in the mask
+    num_universals = len(self.universal_var_ids)
+    self._universal_shift: Dict[int, int] = {
+      var_id: num_universals - 1 - i for i, var_id in enumerate(self.universal_var_ids)
+    }
+    self._all_universals_mask: int = (1 << num_universals) - 1
+    
+    # For each existential, (dependency bit position, mask bit) pairs of its universal dependencies,
+    # derived from _dep_index so that mask-based keys match those built by _assignment_key
+    self._dep_mask_bits: Dict[int, List[Tuple[int, int]]] = {
+      exist_id: [(pos, self._universal_shift[dep_id]) for dep_id, pos in dep_index.items()
+                 if dep_id in self._universal_shift]
+      for exist_id, dep_index in self._dep_index.items()
+    }
 
     # Ordered decision list structures for existential variables
     # Each existential variable has a decision list of rules
@@ -98,9 +138,15 @@ class DQBFSolver:
     # Key: existential variable ID, Value: current "rule fires" variable ID
     self.rule_fire_vars: Dict[int, int] = {}
     
+    # The values of rule_fire_vars and value_vars kept as parallel lists that are passed
+    # as assumptions, indexed by the compact index of the existential variable (_exist_index)
+    self._rule_fire_list: List[int] = [0] * len(self.existential_var_ids)
+    self._value_list: List[int] = [0] * len(self.existential_var_ids)
+    
     # List of all rule fire variables with their premises for debugging/logging
     # Each element is a tuple: (existential_var_id, fire_var_id, premise_name)
-    self.all_rule_fire_vars: List[Tuple[int, int, str]] = []
+    # premise_name is only recorded when debug logging is enabled (None otherwise)
+    self.all_rule_fire_vars: List[Tuple[int, int, Optional[str]]] = []
     
     # List of all no_rule_fired variables with their indices for debugging/logging
     # Each element is a tuple: (existential_var_id, no_rule_fired_var_id, rule_index)
@@ -110,26 +156,44 @@ class DQBFSolver:
     # Each element is a tuple: (existential_var_id, value_var_id, rule_index)
     self.all_value_vars: List[Tuple[int, int, int]] = []
     
+    # Positions of the entries in the three lists above, grouped by existential variable
+    # Key: existential variable ID, Value: list of indices into the corresponding list
+    self._rule_fire_entries_by_exist: Dict[int, List[int]] = defaultdict(list)
+    self._no_rule_fired_entries_by_exist: Dict[int, List[int]] = defaultdict(list)
+    self._value_entries_by_exist: Dict[int, List[int]] = defaultdict(list)
+    
+    # Number of the next rule to be created in each decision list
+    # Key: existential variable ID, Value: rule number (starting at 2 after init_model)
+    self._next_rule_num: Dict[int, int] = {}
+    
     # Permanent assumptions (for fixed rule conclusions)
     self.permanent_assumptions: List[int] = []
     
-    # Expansion variables: maps (existential_var_id, assignment_tuple) to expansion variable ID
-    # The assignment_tuple is a tuple of literals sorted by abs(lit)
-    # Key: (existential_var_id, tuple of sorted literals)
+    # Expansion variables: maps (existential_var_id, sign_bits, present_bits) to expansion variable ID
+    # The assignment is packed into two bit patterns over the dependency positions (see _assignment_key)
+    # Key: (existential_var_id, sign_bits, present_bits)
     # Value: expansion variable ID
-    self.expansion_vars: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+    self.expansion_vars: Dict[Tuple[int, int, int], int] = {}
     
-    # Set of expansion variable IDs for quick lookup
-    self.expansion_vars_set: Set[int] = set()
+    # Expansion variable IDs in creation (and therefore ascending ID) order
+    self._expansion_var_ids: List[int] = []
+    
+    # Display names of literals for _format_literals, filled on demand
+    # Key: signed literal, Value: name (with "~" prefix for negative literals)
+    self._lit_name: Dict[int, str] = {}
 
     self.expansion_variable_assignment: List[int] = []
     
+    # The expansion variable assignment indexed by variable, rebuilt whenever it is replaced in solve
+    # Key: expansion variable ID, Value: its literal in expansion_variable_assignment
+    self._expansion_lit_by_var: Dict[int, int] = {}
+    
     self.expansion_solver = SAT()
     self.counterexample_solver = SAT(bootstrap_with=matrix)
     
     # Track last counterexample for debugging (to detect if we see the same one twice)
-    self.last_counterexample_existentials: Optional[Set[int]] = None
-    self.last_counterexample_universals: Optional[Set[int]] = None
+    # Key: (existential literals, universal literals) as frozensets, or None before the first one
+    self.last_counterexample_key: Optional[Tuple[FrozenSet[int], FrozenSet[int]]] = None
 
     for exist_var_id in self.existential_var_ids:
       self.init_model(exist_var_id)
@@ -143,16 +207,122 @@ class DQBFSolver:
     Returns:
       Formatted string like "[x1, ~x2, ...]"
     """
-    parts = []
-    for lit in sorted(literals, key=abs):
-      var_id = abs(lit)
-      var_name = self.id_to_name.get(var_id, f"id{var_id}")
-      if lit > 0:
-        parts.append(var_name)
-      else:
-        parts.append(f"~{var_name}")
+    lit_name = self._lit_name
+    parts = [lit_name.get(lit) or self._literal_name(lit) for lit in sorted(literals, key=abs)]
     return "[" + ", ".join(parts) + "]"
   
+  def _literal_name(self, lit: int) -> str:
+    """Get the display name of a literal, caching it in _lit_name.
+    
+    Args:
+      lit: Integer literal
+      
+    Returns:
+      The variable name, prefixed with "~" for negative literals
+    """
+    var_id = abs(lit)
+    var_name = self.id_to_name.get(var_id, f"id{var_id}")
+    name = var_name if lit > 0 else f"~{var_name}"
+    self._lit_name[lit] = name
+    return name
+  
+  def _set_name(self, var_id: int, name: str) -> None:
+    """Set the name of a variable and invalidate its cached literal names.
+    
+    Args:
+      var_id: Variable ID
+      name: New name of the variable
+    """
+    self.id_to_name[var_id] = name
+    self._lit_name.pop(var_id, None)
+    self._lit_name.pop(-var_id, None)
+  
+  @staticmethod
+  def _model_literals(model: List[int], var_ids: List[int]) -> List[int]:
+    """Restrict a SAT model to the given variables.
+    
+    PySAT models are dense: the literal for variable v is stored at index v - 1.
+    Reading the requested positions directly avoids scanning the whole model.
+    
+    Args:
+      model: Model as returned by get_model()
+      var_ids: Sorted list of variable IDs to extract
+      
+    Returns:
+      List of literals of the model over var_ids (variables unknown to the solver are skipped)
+    """
+    num_vars = len(model)
+    return [model[var_id - 1] for var_id in var_ids if var_id <= num_vars]
+  
+  @staticmethod
+  def _model_literal(model: List[int], var_id: int) -> Optional[int]:
+    """Get the literal of a single variable from a dense SAT model.
+    
+    Args:
+      model: Model as returned by get_model()
+      var_id: Variable ID to look up
+      
+    Returns:
+      The literal of var_id in the model, or None if the solver does not know the variable
+    """
+    return model[var_id - 1] if 0 < var_id <= len(model) else None
+  
+  def _assignment_key(self, existential_var_id: int, assignment: List[int]) -> Tuple[int, int, int]:
+    """Build the canonical expansion_vars key for an assignment to dependencies.
+    
+    Each dependency of the existential variable owns one bit position. The key records
+    which dependencies are assigned (present_bits) and which of them are True (sign_bits),
+    so it is independent of the order of the literals and needs no sorting.
+    
+    Args:
+      existential_var_id: The ID of the existential variable
+      assignment: List of literals over variables in the dependency set
+      
+    Returns:
+      Tuple (existential_var_id, sign_bits, present_bits)
+      
+    Raises:
+      ValueError: If assignment contains variables not in the dependency set
+    """
+    dep_index = self._dep_index.get(existential_var_id, {})
+    sign_bits = 0
+    present_bits = 0
+    for lit in assignment:
+      pos = dep_index.get(abs(lit))
+      if pos is None:
+        extra_vars = set(abs(l) for l in assignment) - set(dep_index)
+        raise ValueError(f"Assignment contains variables not in dependency set: {extra_vars}")
+      present_bits |= 1 << pos
+      if lit > 0:
+        sign_bits |= 1 << pos
+    return (existential_var_id, sign_bits, present_bits)
+  
+  def _mask_assignment_key(self, existential_var_id: int, mask: int, assigned_mask: int) -> Tuple[int, int, int]:
+    """Build the expansion_vars key of an existential variable for a packed universal assignment.
+    
+    Produces the same key as _assignment_key for the literals of the assigned dependencies.
+    
+    Args:
+      existential_var_id: The ID of the existential variable
+      mask: Values of the universal variables (see _universal_shift)
+      assigned_mask: Bits of the universal variables that are assigned
+      
+    Returns:
+      Tuple (existential_var_id, sign_bits, present_bits)
+    """
+    sign_bits = 0
+    present_bits = 0
+    for pos, shift in self._dep_mask_bits[existential_var_id]:
+      if (assigned_mask >> shift) & 1:
+        present_bits |= 1 << pos
+        if (mask >> shift) & 1:
+          sign_bits |= 1 << pos
+    return (existential_var_id, sign_bits, present_bits)
+  
+  def _mask_literals(self, mask: int) -> List[int]:
+    """Unpack a full universal assignment mask into literals (in universal_var_ids order)."""
+    return [var_id if (mask >> shift) & 1 else -var_id for var_id, shift in self._universal_shift.items()]
+  
   def init_model(self, existential_var_id: int) -> None:
     """Initialize an ordered decision list model for an existential variable.
     
@@ -169,7 +339,7 @@ class DQBFSolver:
     Raises:
       ValueError: If the provided ID is not an existential variable
     """
-    if existential_var_id not in self.existential_var_ids:
+    if existential_var_id not in self._exist_id_set:
       raise ValueError(f"Variable ID {existential_var_id} is not an existential variable")
     
     # Check if already initialized
@@ -182,42 +352,51 @@ class DQBFSolver:
     # Create initial value variable (value_1)
     value_var_1 = self.counter.increase()
     self.value_vars[existential_var_id] = value_var_1
-    self.id_to_name[value_var_1] = f"{exist_name}_value_1"
+    self._set_name(value_var_1, f"{exist_name}_value_1")
     
     # Add to the list of all value variables (index 1 = first value)
+    self._value_entries_by_exist[existential_var_id].append(len(self.all_value_vars))
     self.all_value_vars.append((existential_var_id, value_var_1, 1))
     
     # Create initial "no rule fired up to 0" variable
     no_rule_fired_0 = self.counter.increase()
     self.no_rule_fired_vars[existential_var_id] = no_rule_fired_0
-    self.id_to_name[no_rule_fired_0] = f"{exist_name}_nofired_0"
+    self._set_name(no_rule_fired_0, f"{exist_name}_nofired_0")
     
     # Add to the list of all no_rule_fired variables (index 0 = before any rules)
+    self._no_rule_fired_entries_by_exist[existential_var_id].append(len(self.all_no_rule_fired_vars))
     self.all_no_rule_fired_vars.append((existential_var_id, no_rule_fired_0, 0))
     
     # Create "rule fires" variable for rule 1
     fires_var_1 = self.counter.increase()
     self.rule_fire_vars[existential_var_id] = fires_var_1
-    self.id_to_name[fires_var_1] = f"{exist_name}_fire_1"
+    self._set_name(fires_var_1, f"{exist_name}_fire_1")
     
     # Add to the list of all rule fire variables (initial rule has empty premise)
+    self._rule_fire_entries_by_exist[existential_var_id].append(len(self.all_rule_fire_vars))
     self.all_rule_fire_vars.append((existential_var_id, fires_var_1, "default"))
+    self._next_rule_num[existential_var_id] = 2
+    
+    # Fill the assumption slots for this existential variable
+    index = self._exist_index[existential_var_id]
+    self._rule_fire_list[index] = fires_var_1
+    self._value_list[index] = value_var_1
 
+    clauses: List[List[int]] = []
+    
     # Add unit clause: no rule up to and including 0 fires
-    clause1 = [no_rule_fired_0]
-    self.counterexample_solver.add_clause(clause1)
-    logging.debug(f"Added clause (init {exist_name}): {self._format_literals(clause1)}")
+    clauses.append([no_rule_fired_0])
     
     # Add clauses: if no rule up to 0 fires (~no_rule_fired_0 is true, meaning no_rule_fired_0 is false),
     # then existential_var <=> value_var_0
     # equivalence: (a <=> b) = (a => b) AND (b => a) = (-a OR b) AND (a OR -b)
-    clause2 = [-no_rule_fired_0, -fires_var_1, -existential_var_id, value_var_1]
-    self.counterexample_solver.add_clause(clause2)
-    logging.debug(f"Added clause (init {exist_name}): {self._format_literals(clause2)}")
+    clauses.append([-no_rule_fired_0, -fires_var_1, -existential_var_id, value_var_1])
+    clauses.append([-no_rule_fired_0, -fires_var_1, existential_var_id, -value_var_1])
     
-    clause3 = [-no_rule_fired_0, -fires_var_1, existential_var_id, -value_var_1]
-    self.counterexample_solver.add_clause(clause3)
-    logging.debug(f"Added clause (init {exist_name}): {self._format_literals(clause3)}")
+    self.counterexample_solver.append_formula(clauses, no_return=True)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      for clause in clauses:
+        logging.debug(f"Added clause (init {exist_name}): {self._format_literals(clause)}")
   
   def set_default_value(self, existential_var_id: int, value: bool) -> None:
     """Set the default value for an existential variable's decision list.
@@ -237,7 +416,53 @@ class DQBFSolver:
       raise ValueError(f"Variable {existential_var_id} has not been initialized. Call init_model first.")
     
     current_value_var = self.value_vars[existential_var_id]
-    self.value_vars[existential_var_id] = current_value_var if value else -current_value_var
+    new_value_var = abs(current_value_var) if value else -abs(current_value_var)
+    if new_value_var == current_value_var:
+      return
+    self.value_vars[existential_var_id] = new_value_var
+    self._value_list[self._exist_index[existential_var_id]] = new_value_var
+  
+  @staticmethod
+  def _rule_clauses(
+    existential_var_id: int,
+    premise: List[int],
+    previous_no_rule_fired: int,
+    this_rule_fired: int,
+    this_no_rule_fired: int,
+    next_rule_fired: int,
+    next_value_var: int
+  ) -> List[List[int]]:
+    """Generate the CNF encoding of one decision list rule.
+    
+    This only emits clauses; all bookkeeping (variable names, tracking lists,
+    assumptions) is done by add_rule.
+    
+    Args:
+      existential_var_id: The ID of the existential variable
+      premise: List of literals forming the conjunction (premise of the rule)
+      previous_no_rule_fired: "No rule fired" variable before this rule
+      this_rule_fired: "Rule fires" variable of this rule
+      this_no_rule_fired: "No rule fired" variable after this rule
+      next_rule_fired: "Rule fires" variable of the new default rule
+      next_value_var: Value variable of the new default rule
+      
+    Returns:
+      List of clauses
+    """
+    # Define this_rule_fired
+    clauses = [[-this_rule_fired, lit] for lit in premise]
+    clauses.append([-lit for lit in premise] + [this_rule_fired])
+    
+    # Define next_no_rule_fired
+    clauses.append([-this_no_rule_fired, previous_no_rule_fired])
+    clauses.append([-this_no_rule_fired, -this_rule_fired])
+    clauses.append([this_no_rule_fired, -previous_no_rule_fired, this_rule_fired])
+    
+    # If the default rule fires and no previous rule fired, existential_var <=> value_i
+    clauses.append([-next_rule_fired, -this_no_rule_fired, -existential_var_id, next_value_var])
+    clauses.append([-next_rule_fired, -this_no_rule_fired, existential_var_id, -next_value_var])
+    
+    return clauses
   
   def add_rule(self, existential_var_id: int, premise: List[int], conclusion: bool, value_var: Optional[int] = None) -> None:
     """Add a new rule to the decision list for an existential variable.
@@ -266,6 +491,34 @@ class DQBFSolver:
     if existential_var_id not in self.value_vars:
       raise ValueError(f"Variable {existential_var_id} has not been initialized. Call init_model first.")
     
+    self._add_rule_core(
+      existential_var_id,
+      premise,
+      conclusion,
+      value_var,
+      lambda: self._format_literals(premise) if premise else "true"
+    )
+  
+  def _add_rule_core(
+    self,
+    existential_var_id: int,
+    premise: List[int],
+    conclusion: bool,
+    value_var: Optional[int],
+    premise_name_factory: Callable[[], str]
+  ) -> None:
+    """Add a new rule to an initialized decision list (see add_rule).
+    
+    Args:
+      existential_var_id: The ID of an initialized existential variable
+      premise: List of literals forming the conjunction (premise of the rule)
+      conclusion: The value to assign if the rule fires (True or False)
+      value_var: Optional variable ID to use for the conclusion
+      premise_name_factory: Returns a readable name for the premise. Only called
+                            when debug logging is enabled.
+    """
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
     # Get current state
     previous_no_rule_fired = self.no_rule_fired_vars[existential_var_id]
     this_rule_fired = self.rule_fire_vars[existential_var_id]
@@ -274,13 +527,9 @@ class DQBFSolver:
     # Get the existential variable name for naming auxiliary variables
     exist_name = self.id_to_name.get(existential_var_id, f"var{existential_var_id}")
     
-    # Determine the rule number by parsing the current fire variable name
-    # Extract rule number from name like "var_fire_N"
-    current_fire_name = self.id_to_name.get(abs(this_rule_fired), "")
-    try:
-      rule_num = int(current_fire_name.split("_fire_")[-1]) + 1
-    except (ValueError, IndexError):
-      rule_num = 2  # Default to 2 if parsing fails
+    # Determine the rule number of the new default rule
+    rule_num = self._next_rule_num[existential_var_id]
+    self._next_rule_num[existential_var_id] += 1
     
     # Create new variables
     next_rule_fired = self.counter.increase()
@@ -291,85 +540,72 @@ class DQBFSolver:
     self.rule_fire_vars[existential_var_id] = next_rule_fired
     self.no_rule_fired_vars[existential_var_id] = this_no_rule_fired
     self.value_vars[existential_var_id] = next_value_var
-    
-    # Create a readable name for the premise
-    premise_name = self._format_literals(premise) if premise else "true"
-    
-    # Update the name of this_rule_fired to reflect the premise it now represents
-    # (it was previously the "default" but is now being used for this specific rule)
-    self.id_to_name[abs(this_rule_fired)] = f"{exist_name}_fire_{rule_num - 1}_premise_{premise_name}"
+    index = self._exist_index[existential_var_id]
+    self._rule_fire_list[index] = next_rule_fired
+    self._value_list[index] = next_value_var
+    
+    # Create a readable name for the premise (only needed for debug output)
+    premise_name = None
+    if debug_enabled:
+      premise_name = premise_name_factory()
+      
+      # Update the name of this_rule_fired to reflect the premise it now represents
+      # (it was previously the "default" but is now being used for this specific rule)
+      self._set_name(abs(this_rule_fired), f"{exist_name}_fire_{rule_num - 1}_premise_{premise_name}")
     
     # Update the tracking list entry for this rule fire variable
-    # Find and update the entry that had "default" as the premise
-    for i, (eid, fid, pname) in enumerate(self.all_rule_fire_vars):
-      if eid == existential_var_id and fid == this_rule_fired:
-        self.all_rule_fire_vars[i] = (eid, fid, premise_name)
-        break
+    # The entry that had "default" as the premise is the last one for this existential
+    rule_fire_entries = self._rule_fire_entries_by_exist[existential_var_id]
+    self.all_rule_fire_vars[rule_fire_entries[-1]] = (existential_var_id, this_rule_fired, premise_name)
     
     # Add names for the new variables
-    self.id_to_name[next_rule_fired] = f"{exist_name}_fire_{rule_num}"
-    self.id_to_name[this_no_rule_fired] = f"{exist_name}_nofired_{rule_num - 1}"
-    self.id_to_name[next_value_var] = f"{exist_name}_value_{rule_num}"
+    self._set_name(next_rule_fired, f"{exist_name}_fire_{rule_num}")
+    self._set_name(this_no_rule_fired, f"{exist_name}_nofired_{rule_num - 1}")
+    self._set_name(next_value_var, f"{exist_name}_value_{rule_num}")
     
-    # Count how many rules exist for this existential (length of matching entries in all_rule_fire_vars)
-    rule_index = sum(1 for eid, _, _ in self.all_rule_fire_vars if eid == existential_var_id)
+    # Number of rules that existed for this existential before this call
+    # (rule numbers start at 2 for the first added rule, so this is rule_num - 1)
+    rule_index = rule_num - 1
     
     # Add the new default rule fire variable to the tracking list
+    rule_fire_entries.append(len(self.all_rule_fire_vars))
     self.all_rule_fire_vars.append((existential_var_id, next_rule_fired, "default"))
     
     # Add this no_rule_fired variable to the tracking list
+    self._no_rule_fired_entries_by_exist[existential_var_id].append(len(self.all_no_rule_fired_vars))
     self.all_no_rule_fired_vars.append((existential_var_id, this_no_rule_fired, rule_index))
     
     # Add the new value variable to the tracking list
+    self._value_entries_by_exist[existential_var_id].append(len(self.all_value_vars))
     self.all_value_vars.append((existential_var_id, next_value_var, rule_num))
     
-    # Define this_rule_fired
-    for lit in premise:
-      clause = [-this_rule_fired, lit]
-      self.counterexample_solver.add_clause(clause)
-      logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause)}")
-    clause = [-lit for lit in premise] + [this_rule_fired]
-    self.counterexample_solver.add_clause(clause)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause)}")
-    
-    # Define next_no_rule_fired
-    clause1 = [-this_no_rule_fired, previous_no_rule_fired]
-    self.counterexample_solver.add_clause(clause1)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause1)}")
-    
-    clause2 = [-this_no_rule_fired, -this_rule_fired]
-    self.counterexample_solver.add_clause(clause2)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause2)}")
-    
-    clause3 = [this_no_rule_fired, -previous_no_rule_fired, this_rule_fired]
-    self.counterexample_solver.add_clause(clause3)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause3)}")
-    
-    # Clause 3: if rule fires and no previous rule fired, existential_var <=> value_i
-    clause4 = [-next_rule_fired, -this_no_rule_fired, -existential_var_id, next_value_var]
-    self.counterexample_solver.add_clause(clause4)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause4)}")
-    
-    clause5 = [-next_rule_fired, -this_no_rule_fired, existential_var_id, -next_value_var]
-    self.counterexample_solver.add_clause(clause5)
-    logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause5)}")
+    clauses = self._rule_clauses(
+      existential_var_id,
+      premise,
+      previous_no_rule_fired,
+      this_rule_fired,
+      this_no_rule_fired,
+      next_rule_fired,
+      next_value_var
+    )
     
     # Clause 4: Handle conclusion based on whether value_var is provided
     if value_var is None:
       # Add value_i (or -value_i) as permanent assumption based on conclusion
       conclusion_lit = this_value_var if conclusion else -this_value_var
       self.permanent_assumptions.append(conclusion_lit)
-      logging.debug(f"Added permanent assumption for {exist_name}: {self._format_literals([conclusion_lit])}")
     else:
       # Add equivalence clauses: this_value_var <=> value_var
       # (a <=> b) = (a => b) AND (b => a) = (-a OR b) AND (a OR -b)
-      clause6 = [-this_value_var, value_var]
-      self.counterexample_solver.add_clause(clause6)
-      logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause6)}")
-      
-      clause7 = [this_value_var, -value_var]
-      self.counterexample_solver.add_clause(clause7)
-      logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause7)}")
+      clauses.append([-this_value_var, value_var])
+      clauses.append([this_value_var, -value_var])
+    
+    self.counterexample_solver.append_formula(clauses, no_return=True)
+    if debug_enabled:
+      for clause in clauses:
+        logging.debug(f"Added clause (rule {rule_num} for {exist_name}): {self._format_literals(clause)}")
+      if value_var is None:
+        logging.debug(f"Added permanent assumption for {exist_name}: {self._format_literals([conclusion_lit])}")
   
   def get_expansion_variable(self, existential_var_id: int, assignment: List[int]) -> int:
     """Get or create an expansion variable for an existential variable under a universal assignment.
@@ -390,24 +626,12 @@ class DQBFSolver:
       ValueError: If the existential_var_id is not valid or if assignment contains
                   variables not in the dependency set
     """
-    if existential_var_id not in self.existential_var_ids:
+    if existential_var_id not in self._exist_id_set:
       raise ValueError(f"Variable ID {existential_var_id} is not an existential variable")
     
-    # Get the dependency set for this existential variable
-    dep_set = set(self.dependencies_by_id.get(existential_var_id, []))
-    
-    # Verify that assignment only contains variables from the dependency set
-    assignment_vars = set(abs(lit) for lit in assignment)
-    if not assignment_vars.issubset(dep_set):
-      extra_vars = assignment_vars - dep_set
-      raise ValueError(f"Assignment contains variables not in dependency set: {extra_vars}")
-    
-    # Create a canonical tuple representation of the assignment
-    # Sort literals by absolute value (variable ID) to ensure consistent ordering
-    assignment_tuple = tuple(sorted(assignment, key=abs))
-    
-    # Create the key for the expansion_vars dictionary
-    key = (existential_var_id, assignment_tuple)
+    # Create the canonical key for the expansion_vars dictionary
+    # (also verifies that assignment only contains variables from the dependency set)
+    key = self._assignment_key(existential_var_id, assignment)
     
     # Check if we already have an expansion variable for this combination
     if key in self.expansion_vars:
@@ -416,28 +640,30 @@ class DQBFSolver:
     # Create a new expansion variable
     expansion_var_id = self.counter.increase()
 
-    # Add to id_to_name for debugging
-    if existential_var_id in self.id_to_name:
+    # Add to id_to_name for debugging (only needed when debug output is produced)
+    if existential_var_id in self.id_to_name and logging.getLogger().isEnabledFor(logging.DEBUG):
       exist_name = self.id_to_name[existential_var_id]
       # Create a readable name showing the assignment
       assignment_str = "_".join(f"{abs(lit)}={'T' if lit > 0 else 'F'}" 
-                                for lit in assignment_tuple)
-      self.id_to_name[expansion_var_id] = f"exp_{exist_name}_{assignment_str}"
+                                for lit in sorted(assignment, key=abs))
+      self._set_name(expansion_var_id, f"exp_{exist_name}_{assignment_str}")
       logging.debug(f"Created expansion variable: {self.id_to_name[expansion_var_id]} (ID={expansion_var_id})")
     
     # Store the mapping
     self.expansion_vars[key] = expansion_var_id
 
     # Add a rule for the expansion variable
-    self.add_rule(
+    # (existential_var_id is known to be initialized and assignment was validated above)
+    self._add_rule_core(
       existential_var_id,
-      premise=list(assignment),
-      conclusion=True,
-      value_var=expansion_var_id
+      assignment,
+      True,
+      expansion_var_id,
+      lambda: self._format_literals(assignment) if assignment else "true"
     )
     
-    # Add to expansion variable set
-    self.expansion_vars_set.add(expansion_var_id)
+    # Record the expansion variable ID
+    self._expansion_var_ids.append(expansion_var_id)
     
     return expansion_var_id
   
@@ -450,24 +676,24 @@ class DQBFSolver:
     4. Extracts the failed assumptions (core) from the UNSAT check
     5. Returns the failed assumptions from existential literals, and the full universal assignment
     """
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
     # Step 1: Try to satisfy with negated output gate, rule fire variables, and value variables
     negated_output = -self.output_gate_id
     
     # Build assumptions: negated output + permanent assumptions + rule fire vars + current value vars
-    assumptions_step1 = [negated_output]
-    assumptions_step1.extend(self.permanent_assumptions)
-    
-    # Add all rule fire variables as assumptions
-    assumptions_step1.extend(self.rule_fire_vars.values())
-    
-    # Add all current value variables as assumptions
-    assumptions_step1.extend(self.value_vars.values())
-
-    # Add expansion variable assignment
-    assumptions_step1.extend(self.expansion_variable_assignment)
+    # + expansion variable assignment
+    assumptions_step1 = [
+      negated_output,
+      *self.permanent_assumptions,
+      *self._rule_fire_list,
+      *self._value_list,
+      *self.expansion_variable_assignment
+    ]
 
-    logging.debug(f"Solving with {len(assumptions_step1)} assumptions:")
-    logging.debug(f"  Assumptions: {self._format_literals(assumptions_step1)}")
+    if debug_enabled:
+      logging.debug(f"Solving with {len(assumptions_step1)} assumptions:")
+      logging.debug(f"  Assumptions: {self._format_literals(assumptions_step1)}")
 
     result = self.counterexample_solver.solve(assumptions=assumptions_step1)
     
@@ -480,53 +706,51 @@ class DQBFSolver:
     model = self.counterexample_solver.get_model()
 
     # Get universal and existential literals only
-    counterexample_universals = [lit for lit in model if abs(lit) in self.universal_var_ids]
-    counterexample_existentials = [lit for lit in model if abs(lit) in self.existential_var_ids]
-    
-    logging.debug(f"Found potential counterexample:")
-    logging.debug(f"  Existential assignment: {self._format_literals(counterexample_existentials)}")
-    logging.debug(f"  Universal assignment: {self._format_literals(counterexample_universals)}")
-    
-    # Log rule fire and no_rule_fired variables grouped by existential variable
-    for exist_id in self.existential_var_ids:
-      exist_name = self.id_to_name.get(exist_id, f"id{exist_id}")
-      logging.debug(f"  {exist_name}:")
+    counterexample_universals = self._model_literals(model, self._univ_ids_sorted)
+    counterexample_existentials = self._model_literals(model, self._exist_ids_sorted)
+    
+    # Log the counterexample and the decision list state grouped by existential variable
+    if debug_enabled:
+      logging.debug(f"Found potential counterexample:")
+      logging.debug(f"  Existential assignment: {self._format_literals(counterexample_existentials)}")
+      logging.debug(f"  Universal assignment: {self._format_literals(counterexample_universals)}")
       
-      # Log no_rule_fired variables for this existential
-      for eid, no_rule_fired_var_id, rule_index in self.all_no_rule_fired_vars:
-        if eid == exist_id:
+      for exist_id in self.existential_var_ids:
+        exist_name = self.id_to_name.get(exist_id, f"id{exist_id}")
+        logging.debug(f"  {exist_name}:")
+        
+        # Log no_rule_fired variables for this existential
+        for entry in self._no_rule_fired_entries_by_exist[exist_id]:
+          _, no_rule_fired_var_id, rule_index = self.all_no_rule_fired_vars[entry]
           no_rule_fired_name = self.id_to_name.get(no_rule_fired_var_id, f"id{no_rule_fired_var_id}")
           # Find this variable's assignment in the model
-          for lit in model:
-            if abs(lit) == no_rule_fired_var_id:
-              value = lit > 0
-              logging.debug(f"    {no_rule_fired_name} (after {rule_index} rules) = {value}")
-              break
-      
-      # Log rule fire variables for this existential
-      for eid, fire_var_id, premise_name in self.all_rule_fire_vars:
-        if eid == exist_id:
+          lit = self._model_literal(model, no_rule_fired_var_id)
+          if lit is not None:
+            value = lit > 0
+            logging.debug(f"    {no_rule_fired_name} (after {rule_index} rules) = {value}")
+        
+        # Log rule fire variables for this existential
+        for entry in self._rule_fire_entries_by_exist[exist_id]:
+          _, fire_var_id, premise_name = self.all_rule_fire_vars[entry]
           fire_var_name = self.id_to_name.get(fire_var_id, f"id{fire_var_id}")
           # Find this variable's assignment in the model
-          for lit in model:
-            if abs(lit) == fire_var_id:
-              value = lit > 0
-              logging.debug(f"    {fire_var_name} (premise: {premise_name}) = {value}")
-              break
-      
-      # Log value variables for this existential
-      for eid, value_var_id, value_index in self.all_value_vars:
-        if eid == exist_id:
+          lit = self._model_literal(model, fire_var_id)
+          if lit is not None:
+            value = lit > 0
+            logging.debug(f"    {fire_var_name} (premise: {premise_name}) = {value}")
+        
+        # Log value variables for this existential
+        for entry in self._value_entries_by_exist[exist_id]:
+          _, value_var_id, value_index = self.all_value_vars[entry]
           value_var_name = self.id_to_name.get(abs(value_var_id), f"id{abs(value_var_id)}")
           # Find this variable's assignment in the model
-          for lit in model:
-            if abs(lit) == abs(value_var_id):
-              value = lit > 0
-              # Note: value_var_id might be negated to represent False
-              if value_var_id < 0:
-                value = not value
-              logging.debug(f"    {value_var_name} (for rule {value_index}) = {value}")
-              break
+          lit = self._model_literal(model, abs(value_var_id))
+          if lit is not None:
+            value = lit > 0
+            # Note: value_var_id might be negated to represent False
+            if value_var_id < 0:
+              value = not value
+            logging.debug(f"    {value_var_name} (for rule {value_index}) = {value}")
 
     # Step 3: Call solve again with restricted assignment and unnegated output gate
     unnegated_output = self.output_gate_id
@@ -540,10 +764,11 @@ class DQBFSolver:
     # Step 4: Extract failed existential assumptions
     core = self.counterexample_solver.get_core()
     core = [] if core is None else core
-    existential_core = [lit for lit in core if abs(lit) in self.existential_var_ids]
+    existential_core = [lit for lit in core if abs(lit) in self._exist_id_set]
     
-    logging.debug(f"Counterexample verified:")
-    logging.debug(f"  Existential core: {self._format_literals(existential_core)}")
+    if debug_enabled:
+      logging.debug(f"Counterexample verified:")
+      logging.debug(f"  Existential core: {self._format_literals(existential_core)}")
 
     return (True, (existential_core, counterexample_universals))
   
@@ -554,31 +779,41 @@ class DQBFSolver:
       existential_literals: List of existential variable literals from the counterexample
       universal_literals: List of universal variable literals from the counterexample
     """
-    logging.debug(f"Analyzing counterexample:")
-    logging.debug(f"  Existential literals: {existential_literals}")
-    logging.debug(f"  Universal literals: {universal_literals}")
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
+    if debug_enabled:
+      logging.debug(f"Analyzing counterexample:")
+      logging.debug(f"  Existential literals: {existential_literals}")
+      logging.debug(f"  Universal literals: {universal_literals}")
+    
+    # Index the universal literals by variable
+    univ_map = {abs(lit): lit for lit in universal_literals}
     
     expansion_clause = []
     for exist_lit in existential_literals:
       exist_id = abs(exist_lit)
-      exist_name = self.id_to_name.get(exist_id, exist_id)
-      assignment = [lit for lit in universal_literals if abs(lit) in self.dependencies_by_id.get(exist_id, [])]
+      assignment = [univ_map[dep_id] for dep_id in self.dependencies_by_id_list.get(exist_id, []) if dep_id in univ_map]
       
-      logging.debug(f"  Processing {exist_name}:")
-      logging.debug(f"    Universal assignment: {self._format_literals(assignment)}")
+      if debug_enabled:
+        exist_name = self.id_to_name.get(exist_id, exist_id)
+        logging.debug(f"  Processing {exist_name}:")
+        logging.debug(f"    Universal assignment: {self._format_literals(assignment)}")
       
       expansion_var = self.get_expansion_variable(exist_id, assignment)
       
       if exist_lit > 0:
         expansion_clause.append(-expansion_var)
         self.set_default_value(exist_id, False)
-        logging.debug(f"    Setting default value to False")
+        if debug_enabled:
+          logging.debug(f"    Setting default value to False")
       else:
         expansion_clause.append(expansion_var)
         self.set_default_value(exist_id, True)
-        logging.debug(f"    Setting default value to True")
+        if debug_enabled:
+          logging.debug(f"    Setting default value to True")
 
-    logging.debug(f"Adding expansion clause (blocking clause): {self._format_literals(expansion_clause)}")
+    if debug_enabled:
+      logging.debug(f"Adding expansion clause (blocking clause): {self._format_literals(expansion_clause)}")
     self.expansion_solver.add_clause(expansion_clause)
   
   def compute_model_functions(self, universal_literals: List[int]) -> Optional[List[int]]:
@@ -595,52 +830,88 @@ class DQBFSolver:
       List of existential literals representing the model function outputs,
       or None if the model is unsatisfiable with this universal assignment
     """
+    # Pack the (possibly partial) assignment into value and assigned bits
+    mask = 0
+    assigned_mask = 0
+    for lit in universal_literals:
+      shift = self._universal_shift.get(abs(lit))
+      if shift is not None:
+        assigned_mask |= 1 << shift
+        if lit > 0:
+          mask |= 1 << shift
+    return self.compute_model_functions_mask(mask, assigned_mask, universal_literals)
+  
+  def compute_model_functions_mask(
+    self,
+    mask: int,
+    assigned_mask: Optional[int] = None,
+    universal_literals: Optional[List[int]] = None
+  ) -> Optional[List[int]]:
+    """Compute the outputs of the model functions for a universal assignment given as a bitmask.
+    
+    Universal variable universal_var_ids[i] is True iff bit (n - 1 - i) of mask is set,
+    where n is the number of universal variables (see _universal_shift).
+    
+    Args:
+      mask: Integer encoding the values of the universal variables
+      assigned_mask: Bits of the assigned universal variables (all of them if None)
+      universal_literals: The same assignment as literals, if the caller already has it
+      
+    Returns:
+      List of existential literals representing the model function outputs,
+      or None if the model is unsatisfiable with this universal assignment
+    """
+    if assigned_mask is None:
+      assigned_mask = self._all_universals_mask
+    if universal_literals is None:
+      universal_literals = self._mask_literals(mask)
+    
     # Build assumptions: permanent assumptions + rule fire vars + current value vars + universal assignment
     # We add only the expansion variable assignments that are relevant to this universal assignment
-    assumptions = []
-    assumptions.extend(self.permanent_assumptions)
-    assumptions.extend(self.rule_fire_vars.values())
-    assumptions.extend(self.value_vars.values())
-    assumptions.extend(universal_literals)
+    assumptions = [
+      *self.permanent_assumptions,
+      *self._rule_fire_list,
+      *self._value_list,
+      *universal_literals
+    ]
     
     # For each existential variable, check if there's an expansion variable for this universal assignment
     # and add its value from expansion_variable_assignment
+    expansion_lit_by_var = self._expansion_lit_by_var
+    
     for exist_id in self.existential_var_ids:
-      # Get the dependency set for this existential variable
-      dep_set = self.dependencies_by_id.get(exist_id, set())
-      
-      # Extract the assignment to dependent universal variables
-      assignment = [lit for lit in universal_literals if abs(lit) in dep_set]
-      assignment_tuple = tuple(sorted(assignment, key=abs))
-      
       # Check if we have an expansion variable for this combination
-      key = (exist_id, assignment_tuple)
+      key = self._mask_assignment_key(exist_id, mask, assigned_mask)
       if key in self.expansion_vars:
         exp_var_id = self.expansion_vars[key]
         # Find the value of this expansion variable in expansion_variable_assignment
-        for lit in self.expansion_variable_assignment:
-          if abs(lit) == exp_var_id:
-            assumptions.append(lit)
-            break
+        exp_lit = expansion_lit_by_var.get(exp_var_id)
+        if exp_lit is not None:
+          assumptions.append(exp_lit)
     
-    logging.debug(f"Computing model functions for universal assignment: {self._format_literals(universal_literals)}")
-    logging.debug(f"  Using {len(assumptions)} assumptions: {self._format_literals(assumptions)}")
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
+    if debug_enabled:
+      logging.debug(f"Computing model functions for universal assignment: {self._format_literals(universal_literals)}")
+      logging.debug(f"  Using {len(assumptions)} assumptions: {self._format_literals(assumptions)}")
     
     result = self.counterexample_solver.solve(assumptions=assumptions)
     
     if not result:
-      logging.debug(f"  Model is unsatisfiable with this universal assignment")
-      # Let's debug what's in the core
-      core = self.counterexample_solver.get_core()
-      if core:
-        logging.debug(f"  Core (conflicting assumptions): {self._format_literals(core)}")
+      if debug_enabled:
+        logging.debug(f"  Model is unsatisfiable with this universal assignment")
+        # Let's debug what's in the core
+        core = self.counterexample_solver.get_core()
+        if core:
+          logging.debug(f"  Core (conflicting assumptions): {self._format_literals(core)}")
       return None
     
     # Get the model and extract existential variable assignments
     model = self.counterexample_solver.get_model()
-    existential_assignment = [lit for lit in model if abs(lit) in self.existential_var_ids]
+    existential_assignment = self._model_literals(model, self._exist_ids_sorted)
     
-    logging.debug(f"  Model function outputs: {self._format_literals(existential_assignment)}")
+    if debug_enabled:
+      logging.debug(f"  Model function outputs: {self._format_literals(existential_assignment)}")
     return existential_assignment
   
   def _enumerate_and_compute_model_functions(self) -> bool:
@@ -652,8 +923,6 @@ class DQBFSolver:
     Returns:
       True if all universal assignments have valid outputs, False otherwise
     """
-    from itertools import product
-    
     # Generate all possible assignments to universal variables
     num_universals = len(self.universal_var_ids)
     
@@ -667,17 +936,32 @@ class DQBFSolver:
         logging.error(f"  (no universals): UNSAT (no valid assignment)")
         return False
     
+    # The first universal variable is the most significant bit of the mask (see _universal_shift),
+    # so assignments are enumerated in the same order as itertools.product([False, True], repeat=num_universals)
+    
+    # The model functions only read universal variables some existential depends on,
+    # so assignments that agree on those bits share the same outputs
+    used_mask = 0
+    for var_id, shift in self._universal_shift.items():
+      if var_id in self._dependents_of:
+        used_mask |= 1 << shift
+    
+    # Model function outputs by relevant part of the assignment (valid for this enumeration only)
+    results_by_used_bits: Dict[int, Optional[List[int]]] = {}
+    
     all_valid = True
     # For each combination of True/False for universal variables
-    for assignment_tuple in product([False, True], repeat=num_universals):
+    for mask in range(1 << num_universals):
       # Convert to literals
-      universal_literals = []
-      for i, value in enumerate(assignment_tuple):
-        var_id = self.universal_var_ids[i]
-        universal_literals.append(var_id if value else -var_id)
+      universal_literals = self._mask_literals(mask)
       
-      # Compute model function outputs
-      result = self.compute_model_functions(universal_literals)
+      # Compute model function outputs (unless already known for the relevant bits)
+      used_bits = mask & used_mask
+      if used_bits in results_by_used_bits:
+        result = results_by_used_bits[used_bits]
+      else:
+        result = self.compute_model_functions_mask(mask, universal_literals=universal_literals)
+        results_by_used_bits[used_bits] = result
       
       if result:
         logging.info(f"  {self._format_literals(universal_literals)} → {self._format_literals(result)}")
@@ -693,10 +977,13 @@ class DQBFSolver:
     Returns:
       True if the formula is satisfiable, False otherwise
     """
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
     iteration = 0
     while True:
       iteration += 1
-      logging.debug(f"\n=== Iteration {iteration} ===")
+      if debug_enabled:
+        logging.debug(f"\n=== Iteration {iteration} ===")
       
       has_counterexample, counterexample = self.get_counterexample()
       
@@ -704,14 +991,13 @@ class DQBFSolver:
         logging.info(f"Formula is SATISFIABLE (after {iteration} iterations)")
         
         # Compute and display the model functions for all universal assignments (only in verbose mode)
-        if logging.getLogger().isEnabledFor(logging.DEBUG):
+        if debug_enabled:
           logging.info("Computing model functions for all universal assignments:")
           all_valid = self._enumerate_and_compute_model_functions()
           
           if not all_valid:
             logging.error("ERROR: Cannot compute outputs for some universal assignments")
             logging.error("This indicates an internal error in the solver")
-            import sys
             sys.exit(1)
         
         return True
@@ -719,35 +1005,36 @@ class DQBFSolver:
       existential_core, universal_assignment = counterexample
       
       # Check if this is the same counterexample as the last one (debugging check)
-      current_exist_set = set(existential_core)
-      current_univ_set = set(universal_assignment)
+      current_key = (frozenset(existential_core), frozenset(universal_assignment))
       
-      if (self.last_counterexample_existentials is not None and 
-          self.last_counterexample_universals is not None):
-        if (current_exist_set == self.last_counterexample_existentials and
-            current_univ_set == self.last_counterexample_universals):
-          logging.error("ERROR: Same counterexample seen twice in a row!")
-          logging.error(f"  Existential: {self._format_literals(existential_core)}")
-          logging.error(f"  Universal: {self._format_literals(universal_assignment)}")
-          logging.error("This indicates the solver is not making progress")
-          import sys
-          sys.exit(1)
+      if current_key == self.last_counterexample_key:
+        logging.error("ERROR: Same counterexample seen twice in a row!")
+        logging.error(f"  Existential: {self._format_literals(existential_core)}")
+        logging.error(f"  Universal: {self._format_literals(universal_assignment)}")
+        logging.error("This indicates the solver is not making progress")
+        sys.exit(1)
       
       # Store this counterexample for next iteration
-      self.last_counterexample_existentials = current_exist_set
-      self.last_counterexample_universals = current_univ_set
+      self.last_counterexample_key = current_key
       
       self.analyze_counterexample(existential_core, universal_assignment)
       
-      logging.debug(f"Checking expansion solver (with {len(self.expansion_vars)} expansion variables)...")
+      if debug_enabled:
+        logging.debug(f"Checking expansion solver (with {len(self.expansion_vars)} expansion variables)...")
       if not self.expansion_solver.solve():
         logging.info(f"Formula is UNSATISFIABLE (after {iteration} iterations)")
         return False
       
+      # The model is dense (variable v at index v-1), so read the expansion variables directly
       model = self.expansion_solver.get_model()
-      self.expansion_variable_assignment = [lit for lit in model if abs(lit) in self.expansion_vars_set]
-      logging.debug(f"Expansion model found: {len(self.expansion_variable_assignment)} expansion variable assignments")
-      logging.debug(f"  Assignments: {self.expansion_variable_assignment}")
+      model_len = len(model)
+      self.expansion_variable_assignment = [
+        model[var_id - 1] for var_id in self._expansion_var_ids if var_id <= model_len
+      ]
+      self._expansion_lit_by_var = {abs(lit): lit for lit in self.expansion_variable_assignment}
+      if debug_enabled:
+        logging.debug(f"Expansion model found: {len(self.expansion_variable_assignment)} expansion variable assignments")
+        logging.debug(f"  Assignments: {self.expansion_variable_assignment}")
   
   def detect_equivalent_existentials(self) -> Dict[int, List[int]]:
     """Detect equivalent existential variables.
@@ -755,7 +1042,7 @@ class DQBFSolver:
     Two existential variables are equivalent if they have the same dependencies
     and cannot be forced to different values under any assignment to their dependencies.
     
-    This method groups existentials by the number of dependencies, then for each group,
+    This method groups existentials by their set of dependencies, then for each group,
     checks pairs of variables to see if they can be different.
     
     Returns:
@@ -765,16 +1052,20 @@ class DQBFSolver:
     logging.info("Detecting equivalent existential variables...")
 
     # Union-Find data structure to track equivalence classes
+    # Elements are addressed by their compact index (0..n-1) into the elements list
     class UnionFind:
       def __init__(self, elements):
-        self.parent = {elem: elem for elem in elements}
-        self.rank = {elem: 0 for elem in elements}
+        self.elements = list(elements)
+        self.parent = list(range(len(self.elements)))
+        self.rank = bytearray(len(self.elements))
       
       def find(self, x):
-        """Find representative with path compression."""
-        if self.parent[x] != x:
-          self.parent[x] = self.find(self.parent[x])
-        return self.parent[x]
+        """Find representative index with path halving."""
+        parent = self.parent
+        while parent[x] != x:
+          parent[x] = parent[parent[x]]
+          x = parent[x]
+        return x
       
       def union(self, x, y):
         """Union by rank."""
@@ -793,15 +1084,11 @@ class DQBFSolver:
           self.parent[root_y] = root_x
           self.rank[root_x] += 1
       
-      def same_set(self, x, y):
-        """Check if x and y are in the same equivalence class."""
-        return self.find(x) == self.find(y)
-      
       def get_classes(self):
-        """Get all equivalence classes as a dictionary."""
+        """Get all equivalence classes as a dictionary of representative element to members."""
         classes = {}
-        for elem in self.parent:
-          root = self.find(elem)
+        for i, elem in enumerate(self.elements):
+          root = self.elements[self.find(i)]
           if root not in classes:
             classes[root] = []
           classes[root].append(elem)
@@ -809,60 +1096,105 @@ class DQBFSolver:
 
     detection_solver = SAT(bootstrap_with=self.matrix)
     
-    # Initialize union-find with all existential variables
+    # Fixed encoding shared by all pair queries, so that no clauses are added per pair:
+    # two fresh variables that always take different values, and for every existential
+    # variable e two selectors select_a[e] => (e <=> differ_a) and select_b[e] => (e <=> differ_b).
+    # Assuming select_a[var1] and select_b[var2] forces var1 and var2 to differ.
+    # The clauses are collected first and added to the solver in a single call
+    differ_a = self.counter.increase()
+    differ_b = self.counter.increase()
+    clauses = [[differ_a, differ_b], [-differ_a, -differ_b]]
+    
+    select_a: Dict[int, int] = {}
+    select_b: Dict[int, int] = {}
+    for exist_id in self.existential_var_ids:
+      sel_a = self.counter.increase()
+      select_a[exist_id] = sel_a
+      clauses.append([-sel_a, -exist_id, differ_a])
+      clauses.append([-sel_a, exist_id, -differ_a])
+      sel_b = self.counter.increase()
+      select_b[exist_id] = sel_b
+      clauses.append([-sel_b, -exist_id, differ_b])
+      clauses.append([-sel_b, exist_id, -differ_b])
+    detection_solver.append_formula(clauses, no_return=True)
+    
+    # Initialize union-find with all existential variables (indexed by _exist_index)
     uf = UnionFind(self.existential_var_ids)
+    exist_index = self._exist_index
     
-    # Group existentials by number of dependencies
-    by_dep_count: Dict[int, List[int]] = {}
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
+    # Names of all existentials, looked up once
+    name_by_id = {e: self.id_to_name.get(e, str(e)) for e in self.existential_var_ids}
+    
+    # Group existentials by their set of dependencies (as a sorted tuple of IDs)
+    # Only variables with identical dependencies can be equivalent
+    by_dep_key: Dict[Tuple[int, ...], List[int]] = {}
     for exist_id in self.existential_var_ids:
-      dep_count = len(self.dependencies_by_id_list.get(exist_id, []))
-      if dep_count not in by_dep_count:
-        by_dep_count[dep_count] = []
-      by_dep_count[dep_count].append(exist_id)
-    
-    logging.debug(f"Grouped {len(self.existential_var_ids)} existentials by dependency count:")
-    for dep_count, group in sorted(by_dep_count.items()):
-      logging.debug(f"  {dep_count} dependencies: {len(group)} variables")
-    
-    # For each group with the same dependency count
-    for dep_count, group in sorted(by_dep_count.items()):
-      logging.debug(f"Checking {len(group)} variables with {dep_count} dependencies...")
+      dep_key = tuple(sorted(self.dependencies_by_id.get(exist_id, frozenset())))
+      if dep_key not in by_dep_key:
+        by_dep_key[dep_key] = []
+      by_dep_key[dep_key].append(exist_id)
+    
+    if debug_enabled:
+      logging.debug(f"Grouped {len(self.existential_var_ids)} existentials into {len(by_dep_key)} dependency sets:")
+      for dep_key, group in sorted(by_dep_key.items()):
+        logging.debug(f"  {[self.id_to_name.get(d, str(d)) for d in dep_key]}: {len(group)} variables")
+    
+    # Structural information for deciding some pairs without a SAT call:
+    # existentials occurring in the matrix at all, and whether the output can be
+    # satisfied at all (otherwise no pair can be forced to differ).
+    # Only gathered if some group contains a pair to check.
+    occurring: Set[int] = set()
+    output_satisfiable = True
+    if any(len(group) >= 2 for group in by_dep_key.values()):
+      exist_id_set = self._exist_id_set
+      for clause in self.matrix:
+        for lit in clause:
+          if abs(lit) in exist_id_set:
+            occurring.add(abs(lit))
+      output_satisfiable = detection_solver.solve(assumptions=[self.output_gate_id])
+    
+    # For each group with the same dependencies
+    for dep_key, group in sorted(by_dep_key.items()):
+      if len(group) < 2:
+        continue
+      if debug_enabled:
+        logging.debug(f"Checking {len(group)} variables with {len(dep_key)} dependencies...")
       
-      # Check all pairs in this group
-      for i in range(len(group)):
-        var1_id = group[i]
-        var1_name = self.id_to_name.get(var1_id, str(var1_id))
+      # Partition refinement: every variable is compared against one representative
+      # of each class formed so far in this group and joins the first class it is
+      # equivalent to (equivalence is transitive), or starts a new class otherwise
+      reps: List[int] = []
+      for var1_id in group:
+        var1_name = name_by_id[var1_id]
         
-        for j in range(i + 1, len(group)):
-          var2_id = group[j]
-          var2_name = self.id_to_name.get(var2_id, str(var2_id))
+        for var2_id in reps:
+          var2_name = name_by_id[var2_id]
           
-          # Skip if already in the same equivalence class
-          if uf.same_set(var1_id, var2_id):
-            logging.debug(f"  Skipping {var1_name} and {var2_name}: already equivalent")
-            continue
+          if debug_enabled:
+            logging.debug(f"  Checking pair: {var2_name} and {var1_name}")
+            deps1 = self.dependencies_by_id_list.get(var1_id, [])
+            deps2 = self.dependencies_by_id_list.get(var2_id, [])
+            logging.debug(f"    {var2_name} deps: {[self.id_to_name.get(d, str(d)) for d in deps2]}")
+            logging.debug(f"    {var1_name} deps: {[self.id_to_name.get(d, str(d)) for d in deps1]}")
           
-          # Get dependencies for both variables (in order)
-          deps1 = self.dependencies_by_id_list.get(var1_id, [])
-          deps2 = self.dependencies_by_id_list.get(var2_id, [])
-          
-          logging.debug(f"  Checking pair: {var1_name} and {var2_name}")
-          logging.debug(f"    {var1_name} deps: {[self.id_to_name.get(d, str(d)) for d in deps1]}")
-          logging.debug(f"    {var2_name} deps: {[self.id_to_name.get(d, str(d)) for d in deps2]}")
-          
-          assumption_variable = self.counter.increase()
-          for dep_var1, dep_var2 in zip(deps1, deps2):
-            detection_solver.add_clause([-assumption_variable, dep_var1, -dep_var2])
-            detection_solver.add_clause([-assumption_variable, -dep_var1, dep_var2])
-
-          detection_solver.add_clause([-assumption_variable, var1_id, var2_id])
-          detection_solver.add_clause([-assumption_variable, -var1_id, -var2_id])
-
-          result = detection_solver.solve(assumptions=[assumption_variable, self.output_gate_id])
+          if not output_satisfiable:
+            result = False
+          elif var1_id not in occurring or var2_id not in occurring:
+            # A variable that does not occur in the matrix can take either value in any model
+            result = True
+          else:
+            # Both variables read the same dependencies, so it suffices to force them to differ
+            assumptions = [select_a[var2_id], select_b[var1_id], self.output_gate_id]
+            result = detection_solver.solve(assumptions=assumptions)
           
           if not result:
-            logging.info(f"  Found equivalent variables: {var1_name} and {var2_name}")
-            uf.union(var1_id, var2_id)
+            logging.info(f"  Found equivalent variables: {var2_name} and {var1_name}")
+            uf.union(exist_index[var2_id], exist_index[var1_id])
+            break
+        else:
+          reps.append(var1_id)
     
     # Get final equivalence classes
     equivalence_classes = uf.get_classes()
@@ -885,13 +1217,24 @@ class DQBFSolver:
     Returns:
       Dictionary with formula statistics
     """
+    # Count, total size and maximum size of the clauses in a single pass
+    num_clauses = 0
+    total_size = 0
+    max_size = 0
+    for clause in self.matrix:
+      size = len(clause)
+      num_clauses += 1
+      total_size += size
+      if size > max_size:
+        max_size = size
+    
     return {
       'total_variables': len(self.name_to_id),
       'universal_variables': len(self.universal_vars),
       'existential_variables': len(self.existential_vars),
-      'clauses': len(self.matrix),
-      'max_clause_size': max(len(clause) for clause in self.matrix) if self.matrix else 0,
-      'avg_clause_size': sum(len(clause) for clause in self.matrix) / len(self.matrix) if self.matrix else 0,
+      'clauses': num_clauses,
+      'max_clause_size': max_size,
+      'avg_clause_size': total_size / num_clauses if num_clauses else 0,
       'max_dependencies': max(len(deps) for deps in self.dependencies.values()) if self.dependencies else 0,
     }
   
@@ -939,18 +1282,22 @@ class DQBFSolver:
     print("\n" + "-" * 60)
     print(f"Full CNF Encoding ({stats['clauses']} clauses):")
     print("-" * 60)
-    for i, clause in enumerate(self.matrix, 1):
-      # Convert clause to use variable names
-      lit_strs = []
+    # Name table indexed by variable ID, with one entry per polarity
+    max_id = max(self.id_to_name, default=0)
+    for clause in self.matrix:
       for lit in clause:
-        var_id = abs(lit)
-        var_name = self.id_to_name.get(var_id, f"id{var_id}")
-        if lit > 0:
-          lit_strs.append(var_name)
-        else:
-          lit_strs.append(f"¬{var_name}")
-      clause_str = ' ∨ '.join(lit_strs)
-      print(f"  {i}. {clause_str}")
+        if abs(lit) > max_id:
+          max_id = abs(lit)
+    name_arr = [f"id{var_id}" for var_id in range(max_id + 1)]
+    for var_id, var_name in self.id_to_name.items():
+      name_arr[var_id] = var_name
+    neg_name_arr = [f"¬{var_name}" for var_name in name_arr]
+    lines = []
+    for i, clause in enumerate(self.matrix, 1):
+      clause_str = ' ∨ '.join([name_arr[lit] if lit > 0 else neg_name_arr[-lit] for lit in clause])
+      lines.append(f"  {i}. {clause_str}\n")
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
     
     print()
   